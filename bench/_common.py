@@ -0,0 +1,113 @@
+"""
+Khởi tạo server.py cho các script benchmark.
+
+Mặc định chạy trên mongod thật: BENCH_MONGODB_URI (mặc định mongodb://localhost:27017),
+DB riêng BENCH_DB_NAME (mặc định quiz_bench, bị xóa sạch mỗi lần chạy). BENCH_MONGOMOCK=1
+chỉ để chạy thử script - số đo trên mongomock không có ý nghĩa.
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import bson
+from pymongo import monitoring
+
+BENCH_DB_NAME = os.getenv("BENCH_DB_NAME", "quiz_bench")
+if "bench" not in BENCH_DB_NAME:
+    sys.exit("BENCH_DB_NAME phải chứa 'bench' (DB này bị xóa sạch khi chạy benchmark)")
+
+os.environ.update({
+    "MONGODB_URI": os.getenv("BENCH_MONGODB_URI", "mongodb://localhost:27017"),
+    "DB_NAME": BENCH_DB_NAME,
+    "ENABLE_SCHEDULERS": "0",
+    "DERIVED_TASKS_ASYNC": "0",
+    "REPORT_CACHE": "0",
+    "RESPONSE_MATRIX_CACHE": "1",
+    "RESPONSE_MATRIX_DIR": tempfile.mkdtemp(prefix="bench_matrices_"),
+    "ANALYTICS_EXPORT_DIR": tempfile.mkdtemp(prefix="bench_exports_"),
+})
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Đếm số lệnh gửi tới MongoDB (số round-trip); mongomock không phát sự kiện -> None."""
+
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+command_counter = CommandCounter()
+BENCH_MONGOMOCK = os.getenv("BENCH_MONGOMOCK") == "1"
+if not BENCH_MONGOMOCK:
+    monitoring.register(command_counter) # Trước khi server.py tạo MongoClient
+else:
+    import mongomock
+    import mongomock.collection
+    import mongomock.gridfs
+    import pymongo
+    pymongo.MongoClient = mongomock.MongoClient
+    mongomock.gridfs.enable_gridfs_integration()
+
+    # pymongo >= 4.11 truyền thêm sort=None / namespace=None cho bulk_write mà mongomock chưa nhận
+    def _drop_unset_bulk_kwargs(method):
+        def wrapper(self, *args, **kwargs):
+            for name in ("sort", "namespace"):
+                if kwargs.get(name, 0) is None:
+                    kwargs.pop(name)
+            return method(self, *args, **kwargs)
+        return wrapper
+
+    for _name in ("add_update", "add_replace", "add_delete"):
+        setattr(mongomock.collection.BulkOperationBuilder, _name,
+                _drop_unset_bulk_kwargs(getattr(mongomock.collection.BulkOperationBuilder, _name)))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server  # noqa: E402
+
+db = server.db
+client = server.app.test_client()
+
+
+def reset_db():
+    for name in db.list_collection_names():
+        db[name].drop()
+    server._ensure_indexes()
+
+
+def count_commands(fn):
+    """Chạy fn() 1 lần; trả về (số lệnh MongoDB đã gửi hoặc None, kết quả)."""
+    before = command_counter.count
+    result = fn()
+    return (None if BENCH_MONGOMOCK else command_counter.count - before), result
+
+
+def timed(fn, repeat=5):
+    """Chạy fn() repeat lần; trả về (trung vị ms, kết quả lần cuối)."""
+    samples, result = [], None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(samples), result
+
+
+def bson_size(docs):
+    """Tổng kích thước BSON (byte) của các document - ước lượng lượng dữ liệu truyền từ DB."""
+    return sum(len(bson.encode(doc)) for doc in docs)
+
+
+def print_table(title, header, rows):
+    widths = [max(len(str(cell)) for cell in column) for column in zip(header, *rows)]
+    print(f"\n{title}")
+    for row in (header, ["-" * w for w in widths], *rows):
+        print("  ".join(str(cell).ljust(w) for cell, w in zip(row, widths)))
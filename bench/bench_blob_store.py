@@ -0,0 +1,115 @@
+"""
+Benchmark tách bản vẽ (câu draw, teacherDrawing) khỏi results sang kho blob GridFS
+theo nội dung (sha256): kích thước collection results, dung lượng kho blob và tỉ lệ
+khử trùng, thời gian quét results trước / sau migration results_externalize_draw_blobs.
+
+    python bench/bench_blob_store.py --results 2000 --draw-questions 2 --distinct-drawings 300
+"""
+import argparse
+import base64
+import random
+import time
+
+from _common import bson_size, client, db, print_table, reset_db, server, timed
+
+TEST_ID = "bench-draw"
+
+
+def drawing(rng, size_kb):
+    return "data:image/png;base64," + base64.b64encode(rng.randbytes(size_kb * 768)).decode("ascii")
+
+
+def seed(n_results, draw_questions, distinct_drawings, drawing_kb):
+    rng = random.Random(3)
+    # Nhiều bài làm trùng bản vẽ (nộp lại, chép mẫu, nét vẽ trống giống nhau...)
+    pool = [drawing(rng, drawing_kb) for _ in range(distinct_drawings)]
+    teacher_pool = pool[:max(1, distinct_drawings // 10)]
+    draw_ids = [f"d{j}" for j in range(draw_questions)]
+    batch = []
+    for i in range(n_results):
+        details = [{"questionId": f"q{j}", "type": "mc", "isCorrect": rng.random() < 0.6, "studentAnswer": "A",
+                    "pointsGained": 1, "maxPoints": 1} for j in range(10)]
+        answers = [{"questionId": f"q{j}", "answer": "A"} for j in range(10)]
+        for qid in draw_ids:
+            image = rng.choice(pool)
+            detail = {"questionId": qid, "type": "draw", "studentAnswer": image, "pointsGained": 1, "maxPoints": 2}
+            if rng.random() < 0.3:
+                detail["teacherDrawing"] = rng.choice(teacher_pool)
+            details.append(detail)
+            answers.append({"questionId": qid, "answer": image}) # bản vẽ bị lưu 2 lần trong bài làm
+        batch.append({
+            "id": f"r{i}", "testId": TEST_ID, "studentId": f"s{i}", "className": "4A", "totalScore": rng.uniform(0, 10),
+            "gradingStatus": "Hoàn tất", "resultType": server.RESULT_TYPE_OFFICIAL,
+            "detailedResults": details, "studentAnswers": answers,
+        })
+        if len(batch) == 200:
+            db.results.insert_many(batch)
+            batch = []
+    if batch:
+        db.results.insert_many(batch)
+
+
+def scan():
+    """Quét như các báo cáo đọc cả detailedResults (vd. phân tích tiến độ / dashboard)."""
+    return sum(1 for _ in db.results.find({"testId": TEST_ID}, {"_id": 0, "detailedResults": 1, "studentAnswers": 1}))
+
+
+def blob_store_bytes():
+    rows = list(db["fs.files"].aggregate([{"$group": {"_id": None, "n": {"$sum": 1}, "bytes": {"$sum": "$length"}}}]))
+    return (rows[0]["n"], rows[0]["bytes"]) if rows else (0, 0)
+
+
+def referenced_blob_bytes():
+    total = 0
+    for result in db.results.find({}, {"_id": 0, "detailedResults": 1, "studentAnswers": 1}):
+        for container in (result.get("detailedResults") or []) + (result.get("studentAnswers") or []):
+            for value in container.values():
+                if server._is_blob_ref(value):
+                    total += value["size"]
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--results", type=int, default=2000)
+    parser.add_argument("--draw-questions", type=int, default=2)
+    parser.add_argument("--distinct-drawings", type=int, default=300)
+    parser.add_argument("--drawing-kb", type=int, default=48)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    reset_db()
+    seed(args.results, args.draw_questions, args.distinct_drawings, args.drawing_kb)
+    bytes_before = bson_size(db.results.find({}))
+    scan_before, _ = timed(scan, args.repeat)
+
+    t0 = time.perf_counter()
+    migrated = server._migrate_result_blobs()
+    migrate_ms = (time.perf_counter() - t0) * 1000
+
+    bytes_after = bson_size(db.results.find({}))
+    scan_after, _ = timed(scan, args.repeat)
+    blob_count, blob_bytes = blob_store_bytes()
+    referenced = referenced_blob_bytes()
+
+    sample = db["fs.files"].find_one({}, {"_id": 1})
+    fetch_ms, response = timed(lambda: client.get(f"/api/blobs/{sample['_id']}"), args.repeat) if sample else (0, None)
+    assert response is None or response.status_code == 200
+
+    print_table(
+        f"Kho blob: {args.results} bài làm x {args.draw_questions} câu vẽ, {args.distinct_drawings} bản vẽ khác nhau",
+        ["chỉ số", "trước", "sau"], [
+            ["results (MB)", f"{bytes_before / 2**20:.1f}", f"{bytes_after / 2**20:.1f}"],
+            ["quét results (ms)", f"{scan_before:.0f}", f"{scan_after:.0f}"],
+            ["kho blob (MB / số blob)", "-", f"{blob_bytes / 2**20:.1f} / {blob_count}"],
+            ["tổng results + blob (MB)", f"{bytes_before / 2**20:.1f}", f"{(bytes_after + blob_bytes) / 2**20:.1f}"],
+        ],
+    )
+    print(f"\nMigration: {migrated} bài làm trong {migrate_ms:.0f} ms; lấy 1 blob (lazy): {fetch_ms:.1f} ms")
+    if blob_bytes:
+        print(f"Khử trùng: {referenced / 2**20:.1f} MB được tham chiếu, lưu {blob_bytes / 2**20:.1f} MB "
+              f"(x{referenced / blob_bytes:.1f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmark giao bài cả khối (POST /api/assigns/bulk): so với cách cũ (mỗi cặp
+(đề, HS) 1 find_one assignments + 1 find_one classes, cập nhật từng dòng, đếm lại
+từng đề). In thời gian và số lệnh gửi tới MongoDB của từng bước.
+
+    python bench/bench_bulk_assign.py --students 600 --classes 15 --tests 5
+"""
+import argparse
+import time
+from uuid import uuid4
+
+from _common import client, count_commands, db, print_table, reset_db
+
+TEACHER_ID = "bench-teacher"
+
+
+def seed(n_students, n_classes, n_tests):
+    classes = [{"id": f"c{i}", "name": f"4A{i}", "level": "4"} for i in range(n_classes)]
+    db.classes.insert_many(classes)
+    db.users.insert_many([{
+        "id": f"s{i}", "user": f"s{i}", "fullName": f"HS {i}", "role": "student", "level": "4",
+        "classId": classes[i % n_classes]["id"], "className": classes[i % n_classes]["name"],
+    } for i in range(n_students)])
+    test_ids = [f"t{i}" for i in range(n_tests)]
+    db.tests.insert_many([{"id": t_id, "name": f"Đề {t_id}", "subject": "math", "level": "4"} for t_id in test_ids])
+    return [c["id"] for c in classes], test_ids
+
+
+def legacy_assign(test_ids, class_ids, deadline):
+    """Cách truy cập DB của bulk_assign_tests trước user-028 (chỉ phần giao bài)."""
+    students = list(db.users.find({"classId": {"$in": class_ids}}, {"id": 1, "fullName": 1, "className": 1, "classId": 1, "level": 1}))
+    tests = {t["id"]: t for t in db.tests.find({"id": {"$in": test_ids}}, {"_id": 0, "id": 1, "name": 1, "level": 1})}
+    to_insert = []
+    for t_id in test_ids:
+        for student in students:
+            existing = db.assignments.find_one({"testId": t_id, "studentId": student["id"]})
+            class_info = db.classes.find_one({"id": student.get("classId")}, {"name": 1})
+            if existing:
+                db.assignments.update_one({"id": existing["id"]}, {"$set": {"deadline": deadline, "teacherId": TEACHER_ID}})
+            else:
+                to_insert.append({
+                    "id": str(uuid4()), "testId": t_id, "testName": tests[t_id].get("name"), "studentId": student["id"],
+                    "studentName": student.get("fullName"), "className": (class_info or {}).get("name"),
+                    "classId": student.get("classId"), "teacherId": TEACHER_ID, "deadline": deadline, "status": "pending",
+                })
+    if to_insert:
+        db.assignments.insert_many(to_insert)
+    for t_id in test_ids:
+        status = "assigned" if db.assignments.count_documents({"testId": t_id}) else "not_assigned"
+        db.tests.update_one({"id": t_id}, {"$set": {"assignmentStatus": status}})
+
+
+def bulk_assign(payload):
+    response = client.post("/api/assigns/bulk", json={"teacherId": TEACHER_ID, **payload})
+    assert response.status_code < 300, response.get_json()
+    return response.get_json()
+
+
+def measure(label, fn, rows):
+    t0 = time.perf_counter()
+    commands, _ = count_commands(fn)
+    rows.append([label, f"{(time.perf_counter() - t0) * 1000:.0f}", "-" if commands is None else commands,
+                 db.assignments.count_documents({})])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=600)
+    parser.add_argument("--classes", type=int, default=15)
+    parser.add_argument("--tests", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = []
+    reset_db()
+    class_ids, test_ids = seed(args.students, args.classes, args.tests)
+    measure("cũ: giao mới cả khối", lambda: legacy_assign(test_ids, class_ids, "2030-01-01T00:00:00+07:00"), rows)
+    measure("cũ: giao lại (đổi hạn)", lambda: legacy_assign(test_ids, class_ids, "2030-02-01T00:00:00+07:00"), rows)
+
+    reset_db()
+    class_ids, test_ids = seed(args.students, args.classes, args.tests)
+    payload = {"testIds": test_ids, "classIdsToAssign": class_ids}
+    measure("mới: giao mới cả khối", lambda: bulk_assign({**payload, "deadline": "2030-01-01T00:00:00+07:00"}), rows)
+    measure("mới: giao lại (đổi hạn)", lambda: bulk_assign({**payload, "deadline": "2030-02-01T00:00:00+07:00"}), rows)
+    measure("mới: hủy 1 lớp", lambda: bulk_assign({"testIds": test_ids, "classIdsToRemove": class_ids[:1]}), rows)
+
+    duplicates = list(db.assignments.aggregate([
+        {"$group": {"_id": {"t": "$testId", "s": "$studentId"}, "n": {"$sum": 1}}}, {"$match": {"n": {"$gt": 1}}},
+    ]))
+    print_table(
+        f"Giao bài cả khối: {args.students} HS / {args.classes} lớp x {args.tests} đề",
+        ["bước", "ms", "số lệnh MongoDB", "assignments"], rows,
+    )
+    print(f"\nCặp (đề, HS) bị trùng: {len(duplicates)}; index unique: "
+          f"{'uniq_test_student' in db.assignments.index_information()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Benchmark phân tích câu hỏi (psychometrics) dạng vector:
+- chỉ phần tính (_psychometrics) trên ma trận tổng hợp n HS x k câu MC, so với
+  vòng lặp Python thuần (p-value, point-biserial, Cronbach's alpha) - kết quả phải khớp;
+- đầu-cuối GET /api/reports/test/<id>/psychometrics: lần đầu (dựng ma trận từ
+  results) và các lần sau (ma trận mmap trên đĩa).
+
+    python bench/bench_psychometrics.py --students 1000 --items 50
+"""
+import argparse
+import math
+import random
+
+import numpy as np
+
+from _common import client, db, print_table, reset_db, server, timed
+
+TEST_ID = "bench-psy"
+OPTIONS = ["A", "B", "C", "D"]
+
+
+def simulate(n_students, n_items, seed=11):
+    """Câu trả lời MC theo mô hình 2PL: (chỉ số phương án đã chọn n x k, đáp án đúng k)."""
+    rng = np.random.default_rng(seed)
+    ability = rng.normal(size=n_students)
+    difficulty = rng.normal(size=n_items)
+    discrimination = rng.uniform(0.3, 2.0, size=n_items)
+    p_correct = 1 / (1 + np.exp(-discrimination * (ability[:, None] - difficulty)))
+    keys = rng.integers(0, len(OPTIONS), size=n_items)
+    is_correct = rng.random((n_students, n_items)) < p_correct
+    wrong = (keys + rng.integers(1, len(OPTIONS), size=(n_students, n_items))) % len(OPTIONS)
+    return np.where(is_correct, keys, wrong).astype(np.int8), keys.astype(np.int8)
+
+
+def synthetic_matrix(choices, keys):
+    n, k = choices.shape
+    correct = (choices == keys).astype(np.int8)
+    question_ids = [f"q{j}" for j in range(k)]
+    return {
+        "testName": "Bench", "questionIds": question_ids, "types": ["mc"] * k,
+        "options": {qid: list(OPTIONS) for qid in question_ids}, "keyChoices": keys,
+        "maxPoints": np.ones(k, dtype=np.float32), "points": correct.astype(np.float32),
+        "correct": correct, "choices": choices, "graded": np.ones(n, dtype=bool),
+        "totalScores": correct.sum(axis=1).astype(np.float64), "resultIds": [f"r{i}" for i in range(n)],
+    }
+
+
+def loop_reference(choices, keys):
+    """Vòng lặp Python thuần: p-value, point-biserial (tổng trừ câu đang xét), Cronbach's alpha."""
+    n, k = len(choices), len(keys)
+    scores = [[1.0 if choices[i][j] == keys[j] else 0.0 for j in range(k)] for i in range(n)]
+    totals = [sum(row) for row in scores]
+
+    def correlation(xs, ys):
+        mx, my = sum(xs) / n, sum(ys) / n
+        cov = sum((x - mx) * (y - my) for x, y in zip(xs, ys))
+        vx, vy = sum((x - mx) ** 2 for x in xs), sum((y - my) ** 2 for y in ys)
+        return cov / math.sqrt(vx * vy) if vx and vy else float("nan")
+
+    p_values, point_biserial, item_vars = [], [], []
+    for j in range(k):
+        column = [scores[i][j] for i in range(n)]
+        p_values.append(sum(column) / n)
+        point_biserial.append(correlation(column, [totals[i] - column[i] for i in range(n)]))
+        item_vars.append(sum((x - p_values[j]) ** 2 for x in column) / n)
+    mean_total = sum(totals) / n
+    total_var = sum((t - mean_total) ** 2 for t in totals) / n
+    alpha = k / (k - 1) * (1 - sum(item_vars) / total_var)
+    return p_values, point_biserial, alpha
+
+
+def seed_db(choices, keys):
+    n, k = choices.shape
+    question_ids = [f"q{j}" for j in range(k)]
+    db.questions.insert_many([{
+        "id": qid, "q": f"Câu {j}", "type": "mc", "subject": "math", "level": "4", "points": 1,
+        "options": [{"text": text, "correct": o == int(keys[j])} for o, text in enumerate(OPTIONS)],
+    } for j, qid in enumerate(question_ids)])
+    db.tests.insert_one({"id": TEST_ID, "name": "Bench", "subject": "math", "level": "4",
+                         "questions": [{"id": qid, "points": 1} for qid in question_ids]})
+    batch = []
+    for i in range(n):
+        details = [{
+            "questionId": qid, "type": "mc", "studentAnswer": OPTIONS[choices[i, j]],
+            "isCorrect": bool(choices[i, j] == keys[j]), "pointsGained": float(choices[i, j] == keys[j]), "maxPoints": 1.0,
+        } for j, qid in enumerate(question_ids)]
+        batch.append({"id": f"r{i}", "testId": TEST_ID, "studentId": f"s{i}", "className": f"4{'AB'[i % 2]}",
+                      "gradingStatus": "Hoàn tất", "totalScore": sum(d["pointsGained"] for d in details),
+                      "detailedResults": details})
+        if len(batch) == 500:
+            db.results.insert_many(batch)
+            batch = []
+    if batch:
+        db.results.insert_many(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=1000)
+    parser.add_argument("--items", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--skip-db", action="store_true", help="chỉ đo phần tính, không ghi DB")
+    args = parser.parse_args()
+
+    choices, keys = simulate(args.students, args.items)
+    matrix = synthetic_matrix(choices, keys)
+    vector_ms, report = timed(lambda: server._psychometrics(matrix), args.repeat)
+    loop_ms, (p_values, point_biserial, alpha) = timed(lambda: loop_reference(choices.tolist(), keys.tolist()), max(1, args.repeat // 3))
+
+    difficulty = [item["difficulty"] for item in report["items"]]
+    discrimination = [item["discrimination"] for item in report["items"]]
+    matches = (
+        np.allclose(difficulty, p_values, atol=1e-3)
+        and np.allclose(discrimination, point_biserial, atol=1e-3, equal_nan=True)
+        and abs(report["reliability"]["cronbachAlpha"] - alpha) < 1e-3
+    )
+    rows = [
+        ["_psychometrics (NumPy)", f"{vector_ms:.1f}"],
+        ["vòng lặp Python (p, r_pb, alpha)", f"{loop_ms:.1f}"],
+    ]
+
+    if not args.skip_db:
+        reset_db()
+        seed_db(choices, keys)
+        url = f"/api/reports/test/{TEST_ID}/psychometrics"
+        cold_ms, cold = timed(lambda: client.get(url).get_json(), 1)
+        warm_ms, warm = timed(lambda: client.get(url).get_json(), args.repeat)
+        assert cold["success"] and warm["success"], cold
+        rows += [
+            ["endpoint lần đầu (dựng ma trận)", f"{cold_ms:.1f}", f"load {cold['loadMs']} / tính {cold['computeMs']}"],
+            ["endpoint các lần sau (mmap)", f"{warm_ms:.1f}", f"load {warm['loadMs']} / tính {warm['computeMs']}"],
+        ]
+        rows += [["endpoint lớp 4A", f"{timed(lambda: client.get(url + '?className=4A'), args.repeat)[0]:.1f}"]]
+
+    print_table(f"Psychometrics: {args.students} HS x {args.items} câu MC", ["phép đo", "ms (trung vị)", ""],
+                [row + [""] * (3 - len(row)) for row in rows])
+    print(f"\nNumPy khớp vòng lặp Python (p-value, point-biserial, alpha): {matches}; "
+          f"alpha = {report['reliability']['cronbachAlpha']}, KR-20 = {report['reliability']['kr20']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark ảnh chụp câu hỏi trong detailedResults (difficulty / tags / subject / level):
+- trước: bài làm chưa có ảnh chụp -> phân tích thời gian phải $lookup sang questions,
+  phân tích tiến độ phải tra tags trong ngân hàng;
+- migration results_question_snapshots (thời gian backfill);
+- sau: nhóm thẳng trên ảnh chụp, không join.
+
+    python bench/bench_question_snapshots.py --students 200 --results-per-student 10 --questions 60
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+
+from _common import client, db, print_table, reset_db, server, timed
+
+CLASS_NAME = "4A"
+
+# Pipeline phân tích thời gian theo độ khó trước khi có ảnh chụp (join sang questions)
+LEGACY_TIME_PIPELINE = [
+    {"$match": {"className": CLASS_NAME}},
+    {"$unwind": "$detailedResults"},
+    {"$project": {"qId": "$detailedResults.questionId", "duration": "$detailedResults.durationSeconds", "_id": 0}},
+    {"$lookup": {"from": "questions", "localField": "qId", "foreignField": "id", "as": "qInfo"}},
+    {"$unwind": {"path": "$qInfo", "preserveNullAndEmptyArrays": True}},
+    {"$group": {"_id": "$qInfo.difficulty", "avgTime": {"$avg": "$duration"}, "count": {"$sum": 1}}},
+]
+# Cùng phép nhóm trong get_time_analysis hiện tại (đọc ảnh chụp, không join)
+SNAPSHOT_TIME_PIPELINE = [
+    {"$match": {"className": CLASS_NAME}},
+    {"$unwind": "$detailedResults"},
+    {"$project": {"difficulty": "$detailedResults.difficulty", "duration": "$detailedResults.durationSeconds", "_id": 0}},
+    {"$group": {"_id": "$difficulty", "avgTime": {"$avg": "$duration"}, "count": {"$sum": 1}}},
+]
+
+
+def seed(n_students, results_per_student, n_questions, answers_per_result=20):
+    rng = random.Random(7)
+    questions = [{
+        "id": f"q{j}", "q": f"Câu {j}", "type": "mc", "subject": "math", "level": "4",
+        "difficulty": ("easy", "medium", "hard")[j % 3], "tags": [f"tag{j % 8}", f"chủ đề {j % 3}"],
+    } for j in range(n_questions)]
+    db.questions.insert_many(questions)
+    start = datetime(2025, 9, 5, 1, 0)
+    batch = []
+    for s in range(n_students):
+        for r in range(results_per_student):
+            batch.append({
+                "id": f"r{s}-{r}", "testId": f"t{r}", "testName": f"Đề {r}", "studentId": f"s{s}", "className": CLASS_NAME,
+                "subject": "math", "resultType": server.RESULT_TYPE_OFFICIAL, "totalScore": rng.uniform(0, 10),
+                "submittedAtDt": start + timedelta(days=r, minutes=s),
+                "submittedAt": (start + timedelta(days=r, minutes=s)).isoformat() + "Z",
+                "detailedResults": [{
+                    "questionId": q["id"], "type": "mc", "isCorrect": rng.random() < 0.6,
+                    "pointsGained": 1, "maxPoints": 1, "durationSeconds": rng.randint(5, 90),
+                } for q in rng.sample(questions, min(answers_per_result, n_questions))],
+            })
+            if len(batch) == 1000:
+                db.results.insert_many(batch)
+                batch = []
+    if batch:
+        db.results.insert_many(batch)
+
+
+def time_analysis():
+    response = client.get(f"/api/reports/time_analysis?className={CLASS_NAME}")
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def progress_analysis():
+    return server._get_student_progress_analysis(None, CLASS_NAME, None, None, None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=200)
+    parser.add_argument("--results-per-student", type=int, default=10)
+    parser.add_argument("--questions", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    reset_db()
+    seed(args.students, args.results_per_student, args.questions)
+    rows = []
+    ms, legacy_time = timed(lambda: list(db.results.aggregate(LEGACY_TIME_PIPELINE)), args.repeat)
+    rows.append(["phân tích thời gian", "trước ($lookup)", f"{ms:.1f}"])
+    ms, progress_before = timed(progress_analysis, args.repeat)
+    rows.append(["phân tích tiến độ", "trước (tra tags)", f"{ms:.1f}"])
+
+    ms, migrated = timed(server._migrate_result_question_snapshots, 1)
+    rows.append(["migration ảnh chụp", f"{migrated} bài làm", f"{ms:.1f}"])
+
+    ms, _ = timed(lambda: list(db.results.aggregate(SNAPSHOT_TIME_PIPELINE)), args.repeat)
+    rows.append(["phân tích thời gian", "sau (ảnh chụp)", f"{ms:.1f}"])
+    ms, progress_after = timed(progress_analysis, args.repeat)
+    rows.append(["phân tích tiến độ", "sau (ảnh chụp)", f"{ms:.1f}"])
+
+    print_table(
+        f"Ảnh chụp câu hỏi: {args.students} HS x {args.results_per_student} bài, ngân hàng {args.questions} câu",
+        ["báo cáo", "cách đọc", "ms (trung vị)"], rows,
+    )
+    legacy_counts = {row["_id"]: row["count"] for row in legacy_time}
+    after_counts = {row["difficulty"]: row["count"] for row in time_analysis()["byDifficulty"]}
+    print(f"\nSố câu theo độ khó khớp nhau: {legacy_counts == after_counts}; "
+          f"phân tích tag khớp nhau: {progress_before[1] == progress_after[1]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Benchmark chấm lại hàng loạt (_regrade_test) trên n bài làm của 1 đề k câu
+(mc / đúng-sai / điền khuyết xen kẽ, chấm sẵn đúng như _submit_result):
+- dry-run không đổi gì (kiểm tra luôn: phải báo 0 bài thay đổi),
+- dry-run đổi thang điểm, dry-run sửa đáp án,
+- ghi thật (sửa đáp án): số bài được ghi, số lệnh MongoDB.
+
+    python bench/bench_regrade.py --results 5000 --items 40
+"""
+import argparse
+import random
+
+from _common import count_commands, db, print_table, reset_db, server, timed
+
+TEST_ID = "bench-regrade"
+OPTIONS = ["A", "B", "C", "D"]
+TF_ITEMS = 4
+FILL_BLANKS = ["x", "y"]
+
+
+def question(j, rng):
+    q_type = ("mc", "true_false", "fill_blank")[j % 3]
+    base = {"id": f"q{j}", "type": q_type, "subject": "math", "level": "4"}
+    if q_type == "mc":
+        key = rng.randrange(len(OPTIONS))
+        return {**base, "options": [{"text": text, "correct": o == key} for o, text in enumerate(OPTIONS)]}
+    if q_type == "true_false":
+        return {**base, "options": [{"text": f"ý {i}", "correct": rng.random() < 0.5} for i in range(TF_ITEMS)]}
+    return {**base, "options": [{"text": text} for text in FILL_BLANKS]}
+
+
+def answer(q, rng):
+    """Câu trả lời ngẫu nhiên + điểm chấm giống _submit_result (điểm mỗi câu = 1)."""
+    if q["type"] == "mc":
+        value = rng.choice(OPTIONS)
+        correct = next(o["text"] for o in q["options"] if o["correct"])
+        hits, total = int(value == correct), 1
+    elif q["type"] == "true_false":
+        key = [o["correct"] for o in q["options"]]
+        value = [flag if rng.random() < 0.7 else not flag for flag in key]
+        hits, total = sum(a == b for a, b in zip(value, key)), len(key)
+    else:
+        value = [text if rng.random() < 0.6 else "?" for text in FILL_BLANKS]
+        hits, total = sum(a == b for a, b in zip(value, FILL_BLANKS)), len(FILL_BLANKS)
+    points = round(hits / total, 2)
+    is_correct = hits == total if q["type"] == "mc" else (True if hits == total else (None if hits else False))
+    return {"questionId": q["id"], "type": q["type"], "studentAnswer": value,
+            "pointsGained": points, "isCorrect": is_correct, "correctItems": hits}
+
+
+def seed_db(n_results, n_items, seed=5):
+    rng = random.Random(seed)
+    questions = [question(j, rng) for j in range(n_items)]
+    db.questions.insert_many([dict(q) for q in questions])
+    db.tests.insert_one({"id": TEST_ID, "name": "Bench", "subject": "math", "level": "4",
+                         "questions": [{"id": q["id"], "points": 1} for q in questions]})
+    key_id = server._store_answer_key(TEST_ID, server._get_answer_keys([TEST_ID])[TEST_ID])
+    batch = []
+    for i in range(n_results):
+        details = [answer(q, rng) for q in questions]
+        scores = {"mcScore": 0.0, "tfScore": 0.0, "fillScore": 0.0}
+        for d in details:
+            scores[{"mc": "mcScore", "true_false": "tfScore", "fill_blank": "fillScore"}[d["type"]]] += d["pointsGained"]
+        scores = {field: round(value, 2) for field, value in scores.items()}
+        batch.append({
+            "id": f"r{i}", "testId": TEST_ID, "studentId": f"s{i}", "className": f"4{'AB'[i % 2]}",
+            "schemaVersion": server.RESULT_SCHEMA_VERSION, "answerKeyId": key_id, "gradingStatus": "Hoàn tất",
+            "detailedResults": details, **scores, "essayScore": 0.0, "drawScore": 0.0,
+            "totalScore": round(sum(scores.values()), 2),
+        })
+        if len(batch) == 1000:
+            db.results.insert_many(batch)
+            batch = []
+    if batch:
+        db.results.insert_many(batch)
+    return questions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--results", type=int, default=5000)
+    parser.add_argument("--items", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    reset_db()
+    questions = seed_db(args.results, args.items)
+    mc = next(q for q in questions if q["type"] == "mc")
+    new_mc_key = next(o["text"] for o in mc["options"] if not o["correct"])
+    tf = next(q for q in questions if q["type"] == "true_false")
+    new_tf_key = [not o["correct"] for o in tf["options"]]
+
+    rows = []
+    noop_ms, noop = timed(lambda: server._regrade_test(TEST_ID, dry_run=True)[0], args.repeat)
+    rows.append(["dry-run, không đổi", f"{noop_ms:.0f}", noop["changed"], ""])
+    points_ms, points = timed(lambda: server._regrade_test(TEST_ID, {mc["id"]: 2, tf["id"]: 3}, dry_run=True)[0], args.repeat)
+    rows.append(["dry-run, đổi thang điểm 2 câu", f"{points_ms:.0f}", points["changed"], ""])
+    keys = {mc["id"]: new_mc_key, tf["id"]: new_tf_key}
+    keys_ms, keyed = timed(lambda: server._regrade_test(TEST_ID, dry_run=True, key_override=keys)[0], args.repeat)
+    rows.append(["dry-run, sửa đáp án 2 câu", f"{keys_ms:.0f}", keyed["changed"], ""])
+    write_ms, (commands, written) = timed(
+        lambda: count_commands(lambda: server._regrade_test(TEST_ID, dry_run=False, key_override=keys)[0]), 1
+    )
+    rows.append(["ghi thật, sửa đáp án 2 câu", f"{write_ms:.0f}", written["changed"],
+                 "-" if commands is None else commands])
+
+    print_table(f"Chấm lại: {args.results} bài làm x {args.items} câu", ["phép đo", "ms", "bài đổi", "lệnh MongoDB"], rows)
+    print(f"\nKhớp chấm lúc nộp (dry-run không đổi báo 0 bài): {noop['changed'] == 0}; "
+          f"xung đột khi ghi: {len(written['conflicts'])}; "
+          f"~{args.results / max(write_ms / 1000, 1e-9):.0f} bài/giây khi ghi thật")
+
+
+if __name__ == "__main__":
+    main()
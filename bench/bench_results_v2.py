@@ -0,0 +1,114 @@
+"""
+Benchmark schema results v2 (phần tĩnh của đề tách sang answer_keys, bỏ mảng
+studentAnswers trùng lặp): kích thước collection results trước / sau migration
+results_schema_v2, dung lượng answer_keys, thời gian quét bài làm của 1 đề
+(v1 đọc thẳng, v2 qua shim _apply_answer_keys) và chi phí chạy migration.
+
+    python bench/bench_results_v2.py --tests 20 --results-per-test 250 --items 30
+"""
+import argparse
+import random
+import time
+
+from _common import bson_size, count_commands, db, print_table, reset_db, server, timed
+
+OPTIONS = ["A", "B", "C", "D"]
+
+
+def seed(n_tests, results_per_test, n_items):
+    rng = random.Random(7)
+    keys = {}
+    for t in range(n_tests):
+        test_id = f"bench-v2-{t}"
+        questions = []
+        for j in range(n_items):
+            key = rng.randrange(len(OPTIONS))
+            questions.append({
+                "id": f"{test_id}-q{j}", "type": "mc", "subject": "math", "level": "4",
+                "q": f"Câu {j}: " + "nội dung " * 20,
+                "options": [{"text": f"{text} - phương án {text}", "correct": o == key} for o, text in enumerate(OPTIONS)],
+            })
+        db.questions.insert_many(questions)
+        db.tests.insert_one({"id": test_id, "name": f"Bench {t}", "subject": "math", "level": "4",
+                             "questions": [{"id": q["id"], "points": 0.5} for q in questions]})
+        keys[test_id] = questions
+
+    batch = []
+    for test_id, questions in keys.items():
+        for i in range(results_per_test):
+            details, answers = [], []
+            for q in questions:
+                correct = next(o["text"] for o in q["options"] if o["correct"])
+                value = rng.choice(q["options"])["text"]
+                details.append({
+                    "questionId": q["id"], "type": "mc", "studentAnswer": value, "isCorrect": value == correct,
+                    "pointsGained": 0.5 if value == correct else 0.0, "correctItems": int(value == correct),
+                    "durationSeconds": rng.randint(5, 90),
+                    "correctAnswer": correct, "maxPoints": 0.5, "totalItems": 1, # phần tĩnh v1
+                })
+                answers.append({"questionId": q["id"], "answer": value, "durationSeconds": details[-1]["durationSeconds"]})
+            batch.append({
+                "id": f"{test_id}-r{i}", "testId": test_id, "studentId": f"s{i}", "className": "4A",
+                "gradingStatus": "Hoàn tất", "totalScore": sum(d["pointsGained"] for d in details),
+                "detailedResults": details, "studentAnswers": answers,
+            })
+            if len(batch) == 500:
+                db.results.insert_many(batch)
+                batch = []
+    if batch:
+        db.results.insert_many(batch)
+    return list(keys)
+
+
+def scan(test_id):
+    """Đọc bài làm của 1 đề kèm phần tĩnh (như API chi tiết / xuất file)."""
+    results = list(db.results.find({"testId": test_id}, {"_id": 0}))
+    return server._expand_results(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tests", type=int, default=20)
+    parser.add_argument("--results-per-test", type=int, default=250)
+    parser.add_argument("--items", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    reset_db()
+    test_ids = seed(args.tests, args.results_per_test, args.items)
+    probe = test_ids[len(test_ids) // 2]
+    bytes_before = bson_size(db.results.find({}))
+    scan_before, expanded_before = timed(lambda: scan(probe), args.repeat)
+
+    t0 = time.perf_counter()
+    commands, migrated = count_commands(server._migrate_results_to_v2)
+    migrate_ms = (time.perf_counter() - t0) * 1000
+
+    bytes_after = bson_size(db.results.find({}))
+    key_bytes = bson_size(db.answer_keys.find({}))
+    scan_after, expanded_after = timed(lambda: scan(probe), args.repeat)
+    same = [
+        [(d["questionId"], d["correctAnswer"], d["maxPoints"], d["totalItems"]) for d in r["detailedResults"]]
+        for r in expanded_before
+    ] == [
+        [(d["questionId"], d["correctAnswer"], d["maxPoints"], d["totalItems"]) for d in r["detailedResults"]]
+        for r in expanded_after
+    ]
+
+    total = args.tests * args.results_per_test
+    print_table(
+        f"Results v2: {args.tests} đề x {args.results_per_test} bài làm x {args.items} câu",
+        ["chỉ số", "v1", "v2"], [
+            ["results (MB)", f"{bytes_before / 2**20:.2f}", f"{bytes_after / 2**20:.2f}"],
+            ["answer_keys (KB / số key)", "-", f"{key_bytes / 1024:.1f} / {db.answer_keys.count_documents({})}"],
+            ["byte / bài làm", f"{bytes_before / total:.0f}", f"{(bytes_after + key_bytes) / total:.0f}"],
+            [f"quét 1 đề + phần tĩnh (ms, {args.results_per_test} bài)", f"{scan_before:.1f}", f"{scan_after:.1f}"],
+        ],
+    )
+    print(f"\nMigration: {migrated} bài làm trong {migrate_ms:.0f} ms, "
+          f"{'-' if commands is None else commands} lệnh MongoDB (answer key nạp 1 lần mỗi lô)")
+    print(f"Phần tĩnh đọc qua shim khớp bản v1: {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark báo cáo đề (/api/reports/test/<id>): cách tính Python cũ, pipeline $facet
+và ma trận bài làm, trên 1 đề có hàng nghìn bài nộp. In thời gian (trung vị) và lượng
+dữ liệu đọc từ DB của từng cách.
+
+    python bench/bench_test_report.py --results 5000 --questions 40
+"""
+import argparse
+import random
+
+from _common import bson_size, db, print_table, reset_db, server, timed
+
+TEST_ID = "bench-test"
+
+
+def seed(n_results, n_questions):
+    question_ids = [f"q{j}" for j in range(n_questions)]
+    db.questions.insert_many([{"id": qid, "q": f"Câu {qid}", "type": "mc", "points": 1} for qid in question_ids])
+    db.tests.insert_one({"id": TEST_ID, "name": "Bench", "questions": [{"id": qid, "points": 1} for qid in question_ids]})
+    rng = random.Random(42)
+    batch = []
+    for i in range(n_results):
+        details = [{
+            "questionId": qid, "isCorrect": rng.random() < 0.6, "studentAnswer": rng.choice("ABCD"),
+            "pointsGained": 1, "maxPoints": 1,
+        } for qid in question_ids]
+        batch.append({
+            "id": f"r{i}", "testId": TEST_ID, "studentId": f"s{i}", "className": f"4{'ABCD'[i % 4]}",
+            "totalScore": round(rng.uniform(0, 10), 2), "gradingStatus": "Hoàn tất", "detailedResults": details,
+            # Bài làm thật còn mang câu trả lời gốc: cách tính cũ đọc cả phần này về Python
+            "studentAnswers": [{"questionId": qid, "answer": "x" * 200} for qid in question_ids],
+        })
+        if len(batch) == 1000:
+            db.results.insert_many(batch)
+            batch = []
+    if batch:
+        db.results.insert_many(batch)
+    return question_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--results", type=int, default=5000)
+    parser.add_argument("--questions", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    reset_db()
+    question_ids = seed(args.results, args.questions)
+    query = {"testId": TEST_ID}
+    projection = {"_id": 0, "totalScore": 1, "detailedResults.questionId": 1, "detailedResults.isCorrect": 1}
+
+    transfer = {
+        "full": bson_size(db.results.find(query)), # cách đọc trước khi có projection / $facet
+        "python": bson_size(db.results.find(query, projection)),
+        "aggregate": bson_size(db.results.aggregate(server._test_report_pipeline(query, question_ids))),
+        "matrix": 0, # đọc từ file mmap trên đĩa
+    }
+    server._load_response_matrix(TEST_ID) # dựng ma trận 1 lần (không tính vào thời gian)
+    expected = server._test_report_python(query, question_ids)
+    rows = []
+    for engine in ("python", "aggregate", "matrix"):
+        ms, report = timed(lambda: server._TEST_REPORT_ENGINES[engine](query, question_ids), args.repeat)
+        same = report[0]["count"] == expected[0]["count"] and report[1] == expected[1]
+        rows.append([engine, f"{ms:.1f}", f"{transfer[engine] / 1024:.0f}", "ok" if same else "KHÁC"])
+    ms, _ = timed(lambda: list(db.results.find(query)), args.repeat)
+    rows.insert(0, ["full documents", f"{ms:.1f}", f"{transfer['full'] / 1024:.0f}", "-"])
+    print_table(
+        f"Báo cáo đề: {args.results} bài nộp x {args.questions} câu",
+        ["engine", "ms (trung vị)", "KB đọc từ DB", "khớp python"], rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Chạy server.py trên 1 DB riêng (DB_NAME=quiz_test): mongod thật nếu đặt
+TEST_MONGODB_URI (bắt buộc cho các test explain()), ngược lại mongomock.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+from pymongo import monitoring
+
+TEST_MONGODB_URI = os.getenv("TEST_MONGODB_URI")
+os.environ.update({
+    "MONGODB_URI": TEST_MONGODB_URI or "mongodb://localhost:27017",
+    "DB_NAME": "quiz_test",
+    "ENABLE_SCHEDULERS": "0",
+    "DERIVED_TASKS_ASYNC": "0",
+    "RESPONSE_MATRIX_CACHE": "1",
+    "RESPONSE_MATRIX_DIR": tempfile.mkdtemp(prefix="quiz_matrices_"),
+    "ANALYTICS_EXPORT_DIR": tempfile.mkdtemp(prefix="quiz_exports_"),
+})
+
+
+class ResultCommandRecorder(monitoring.CommandListener):
+    """Ghi lại các lệnh đọc trên collection results (để chạy explain() lại đúng lệnh server đã gửi)."""
+
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        if event.command_name in ("find", "aggregate", "count", "distinct") and event.command.get(event.command_name) == "results":
+            self.commands.append(event.command)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+result_commands = ResultCommandRecorder()
+
+if TEST_MONGODB_URI:
+    monitoring.register(result_commands) # Phải đăng ký trước khi server.py tạo MongoClient
+else:
+    import mongomock
+    import mongomock.collection
+    import mongomock.gridfs
+    import pymongo
+    pymongo.MongoClient = mongomock.MongoClient
+    mongomock.gridfs.enable_gridfs_integration()
+
+    # pymongo >= 4.11 truyền thêm sort=None / namespace=None cho bulk_write mà mongomock chưa nhận
+    def _drop_unset_bulk_kwargs(method):
+        def wrapper(self, *args, **kwargs):
+            for name in ("sort", "namespace"):
+                if kwargs.get(name, 0) is None:
+                    kwargs.pop(name)
+            return method(self, *args, **kwargs)
+        return wrapper
+
+    for _name in ("add_update", "add_replace", "add_delete"):
+        setattr(mongomock.collection.BulkOperationBuilder, _name,
+                _drop_unset_bulk_kwargs(getattr(mongomock.collection.BulkOperationBuilder, _name)))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    """DB rỗng cho mỗi test (giữ nguyên index do _ensure_indexes tạo), bỏ cả ma trận bài làm trên đĩa."""
+    for name in server.db.list_collection_names():
+        server.db[name].delete_many({})
+    shutil.rmtree(server.RESPONSE_MATRIX_DIR, ignore_errors=True)
+    with server._response_matrix_lock:
+        server._response_matrix_mmaps.clear()
+    return server.db
+
+
+@pytest.fixture
+def client(db):
+    return server.app.test_client()
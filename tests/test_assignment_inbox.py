@@ -0,0 +1,50 @@
+"""
+_rebuild_assignment_inbox dựng lại inbox từ snapshot assignments + results:
+bài nộp xen vào giữa lúc đọc và lúc ghi không được bị đưa về trạng thái chưa nộp.
+"""
+import server
+
+
+def _seed(db):
+    db.tests.insert_one({"id": "t1", "name": "Đề 1", "subject": "math"})
+    db.assignments.insert_many([
+        {"id": "a-open", "testId": "t1", "studentId": "s1", "status": "pending"},
+        {"id": "a-done", "testId": "t1", "studentId": "s2", "status": "submitted"},
+        {"id": "a-race", "testId": "t1", "studentId": "s3", "status": "pending"},
+    ])
+    db.results.insert_one({"id": "r-done", "assignmentId": "a-done", "testId": "t1", "studentId": "s2",
+                           "gradingStatus": "Hoàn tất", "totalScore": 7.5})
+
+
+def _rows(db):
+    return {row["assignmentId"]: row for row in db.assignment_inbox.find({}, {"_id": 0})}
+
+
+def test_rebuild_writes_rows_with_results(db):
+    _seed(db)
+    assert server._rebuild_assignment_inbox() == 3
+    rows = _rows(db)
+    assert rows["a-open"]["status"] == "pending" and "resultId" not in rows["a-open"]
+    assert rows["a-done"]["status"] == "submitted" and rows["a-done"]["totalScore"] == 7.5
+
+
+def test_rebuild_keeps_row_submitted_during_rebuild(db, monkeypatch):
+    _seed(db)
+    server._rebuild_assignment_inbox()
+    db.assignment_inbox.delete_one({"assignmentId": "a-open"}) # dòng bị mất -> upsert lại
+    collection_type = type(db.assignment_inbox)
+    original_bulk_write = collection_type.bulk_write
+
+    def submit_then_write(self, ops, *args, **kwargs):
+        monkeypatch.setattr(collection_type, "bulk_write", original_bulk_write)
+        # HS nộp a-race sau khi bản dựng lại đã đọc results
+        server._inbox_apply_results([{"id": "r-race", "assignmentId": "a-race", "gradingStatus": "Hoàn tất", "totalScore": 9}])
+        return original_bulk_write(self, ops, *args, **kwargs)
+
+    monkeypatch.setattr(collection_type, "bulk_write", submit_then_write)
+    server._rebuild_assignment_inbox()
+    rows = _rows(db)
+    assert rows["a-race"]["status"] == "submitted"
+    assert rows["a-race"]["resultId"] == "r-race" and rows["a-race"]["totalScore"] == 9
+    assert rows["a-open"]["status"] == "pending"
+    assert db.assignment_inbox.count_documents({}) == 3
@@ -0,0 +1,64 @@
+"""
+Bộ lập lịch hạn nộp: lần nạp đầu tiên sau khi bật không được đóng (và tự nộp)
+các bài đã quá hạn từ trước mốc bật, trừ khi chạy với DEADLINE_BACKFILL=1.
+"""
+from datetime import timedelta
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def deadline_state(monkeypatch):
+    monkeypatch.setattr(server, "_deadline_state", {"loadedUntil": None, "since": None})
+    monkeypatch.setattr(server, "_deadline_heap", [])
+    return server._deadline_state
+
+
+def _assignments(db, now):
+    db.assignments.insert_many([
+        {"id": aid, "testId": "t1", "studentId": aid, "status": "pending", "deadlineAt": deadline_at}
+        for aid, deadline_at in (
+            ("a-old", now - timedelta(days=30)),
+            ("a-due", now + timedelta(seconds=1)),
+            ("a-later", now + timedelta(days=1)),
+        )
+    ])
+
+
+def _statuses(db):
+    return {a["id"]: a["status"] for a in db.assignments.find({}, {"_id": 0, "id": 1, "status": 1})}
+
+
+def test_first_reload_skips_deadlines_before_rollout(db, deadline_state, monkeypatch):
+    now = server.utcnow_naive()
+    _assignments(db, now)
+    server._reload_deadline_heap()
+    assert deadline_state["since"] is not None
+    assert [entry[1] for entry in server._deadline_heap] == ["a-due"]
+
+    # Mốc bật chỉ ghi 1 lần: nạp lại (worker khác, lần khởi động sau) dùng đúng mốc cũ
+    since = deadline_state["since"]
+    deadline_state["since"] = None
+    server._reload_deadline_heap()
+    assert deadline_state["since"] == since
+
+    monkeypatch.setattr(server, "utcnow_naive", lambda: now + timedelta(seconds=2))
+    server._close_due_assignments()
+    assert _statuses(db) == {"a-old": "pending", "a-due": "closed", "a-later": "pending"}
+
+
+def test_backfill_closes_older_deadlines(db, deadline_state, monkeypatch):
+    monkeypatch.setattr(server, "DEADLINE_BACKFILL", True)
+    now = server.utcnow_naive()
+    _assignments(db, now)
+    server._reload_deadline_heap()
+    monkeypatch.setattr(server, "utcnow_naive", lambda: now + timedelta(seconds=2))
+    server._close_due_assignments()
+    assert _statuses(db) == {"a-old": "closed", "a-due": "closed", "a-later": "pending"}
+
+
+def test_schedulers_and_auto_submit_are_opt_in():
+    assert server.AUTO_SUBMIT_DRAFTS is False
+    assert "deadline_scheduler" not in server._background_jobs
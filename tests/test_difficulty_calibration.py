@@ -0,0 +1,33 @@
+"""
+Hiệu chỉnh độ khó: lượt cộng dồn chỉ đọc bài mới, nên job định kỳ phải tự tính
+lại từ đầu khi tới hạn để bài đã đếm rồi đổi điểm (chấm lại) không làm lệch mãi.
+"""
+import server
+
+
+def _result(i, points):
+    return {"id": f"r{i}", "testId": "t1", "studentId": f"s{i}", "detailedResults": [
+        {"questionId": "q1", "type": "mc", "pointsGained": points, "maxPoints": 1.0},
+    ]}
+
+
+def _q1(db):
+    doc = db.question_calibration.find_one({"_id": "q1"})
+    return doc["attempts"], round(doc["scoreSum"], 6)
+
+
+def test_scheduled_runs_recount_when_full_run_is_due(db, monkeypatch):
+    db.questions.insert_one({"id": "q1", "type": "mc", "difficulty": "medium"})
+    db.results.insert_many([_result(0, 1.0), _result(1, 0.0)])
+    assert server._calibrate_difficulty()["full"] is True # chưa có lượt full nào
+    assert _q1(db) == (2, 1.0)
+
+    # Bài đã đếm bị chấm lại + 1 bài mới: lượt cộng dồn chỉ thấy bài mới
+    db.results.update_one({"id": "r1"}, {"$set": {"detailedResults.0.pointsGained": 1.0}})
+    db.results.insert_one(_result(2, 1.0))
+    assert server._calibrate_difficulty()["full"] is False
+    assert _q1(db) == (3, 2.0)
+
+    monkeypatch.setattr(server, "CALIBRATION_FULL_INTERVAL_SECONDS", 0)
+    assert server._calibrate_difficulty()["full"] is True
+    assert _q1(db) == (3, 3.0)
@@ -0,0 +1,81 @@
+"""
+/api/reports/test/<id>/psychometrics: các chỉ số trên 1 bộ dữ liệu nhỏ đã tính
+tay (4 HS x 3 câu MC 1 điểm + 1 câu đúng/sai 2 điểm, có điểm từng phần).
+
+    điểm (points)        đúng hẳn (correct)   tổng
+    s1: 1 1 1 2          1 1 1 1              5
+    s2: 1 1 0 1          1 1 0 0              3
+    s3: 1 0 0 1          1 0 0 0              2
+    s4: 0 0 0 0          0 0 0 0              0
+
+- độ khó = trung bình điểm / điểm tối đa: .75, .5, .25, (2+1+1+0)/8 = .5
+- point-biserial với điểm phần còn lại (tổng - câu đang xét):
+  mc1 ~ (4,2,1,0): 1.75 / sqrt(.75 * 8.75) = .683; mc2 ~ (4,2,2,0): 2 / sqrt(1 * 8) = .707;
+  mc3 ~ (4,3,2,0): 1.75 / sqrt(.75 * 8.75) = .683; tf4 ~ (3,2,1,0): 3 / sqrt(2 * 5) = .949
+- Cronbach's alpha (phương sai ddof=0): var(tổng) = 3.25, tổng var câu = .1875 + .25 + .1875 + .5 = 1.125
+  -> 4/3 * (1 - 1.125 / 3.25) = .872
+- KR-20 trên cột đúng hẳn: tổng (4,2,1,0) var = 2.1875, tổng p(1-p) = .8125 -> 4/3 * (1 - .8125 / 2.1875) = .838
+- SEM = sd(tổng) * sqrt(1 - alpha) = sqrt(3.25) * sqrt(1 - .871795) = .65
+"""
+import pytest
+
+import server
+
+TEST_ID = "t-psy"
+OPTIONS = ["A", "B", "C"]
+MC_KEYS = {"mc1": "A", "mc2": "B", "mc3": "C"}
+# (câu MC trả lời, điểm câu đúng/sai)
+ROWS = [
+    ({"mc1": "A", "mc2": "B", "mc3": "C"}, 2.0),
+    ({"mc1": "A", "mc2": "B", "mc3": "A"}, 1.0),
+    ({"mc1": "a ", "mc2": "C", "mc3": "B"}, 1.0),
+    ({"mc1": "B", "mc2": "A", "mc3": None}, 0.0),
+]
+
+
+@pytest.fixture
+def psy_test(db):
+    db.questions.insert_many([
+        {"id": qid, "q": f"Câu {qid}", "type": "mc", "subject": "math", "level": "4",
+         "options": [{"text": text, "correct": text == key} for text in OPTIONS]}
+        for qid, key in MC_KEYS.items()
+    ] + [{"id": "tf4", "q": "Câu đúng/sai", "type": "true_false", "subject": "math", "level": "4",
+          "options": [{"text": "ý 1", "correct": True}, {"text": "ý 2", "correct": False}]}])
+    db.tests.insert_one({
+        "id": TEST_ID, "name": "Đề phân tích", "subject": "math", "level": "4",
+        "questions": [{"id": qid, "points": 1} for qid in MC_KEYS] + [{"id": "tf4", "points": 2}],
+    })
+    docs = []
+    for i, (answers, tf_points) in enumerate(ROWS):
+        details = [{
+            "questionId": qid, "type": "mc", "studentAnswer": answers[qid],
+            "pointsGained": 1.0 if (answers[qid] or "").strip().upper() == key else 0.0,
+            "isCorrect": (answers[qid] or "").strip().upper() == key,
+        } for qid, key in MC_KEYS.items()]
+        details.append({"questionId": "tf4", "type": "true_false", "studentAnswer": [True, False],
+                        "pointsGained": tf_points, "isCorrect": True if tf_points == 2 else (None if tf_points else False)})
+        docs.append({"id": f"r{i}", "testId": TEST_ID, "studentId": f"s{i}", "className": "4A",
+                     "gradingStatus": "Hoàn tất", "totalScore": sum(d["pointsGained"] for d in details),
+                     "detailedResults": details})
+    db.results.insert_many(docs)
+    return docs
+
+
+def test_psychometrics_matches_hand_computed_fixture(psy_test, client):
+    body = client.get(f"/api/reports/test/{TEST_ID}/psychometrics").get_json()
+    assert body["success"] and body["students"] == 4
+    items = {item["questionId"]: item for item in body["items"]}
+    assert {qid: items[qid]["difficulty"] for qid in items} == {"mc1": 0.75, "mc2": 0.5, "mc3": 0.25, "tf4": 0.5}
+    assert {qid: items[qid]["discrimination"] for qid in items} == {"mc1": 0.683, "mc2": 0.707, "mc3": 0.683, "tf4": 0.949}
+    assert body["reliability"] == {
+        "cronbachAlpha": 0.872, "kr20": 0.838, "sem": 0.65,
+        "meanScore": 2.5, "sdScore": 1.8, "itemCount": 4,
+    }
+
+
+def test_distractor_counts(psy_test, client):
+    body = client.get(f"/api/reports/test/{TEST_ID}/psychometrics").get_json()
+    mc1 = next(item for item in body["items"] if item["questionId"] == "mc1")
+    counts = {d["option"]: (d["count"], d["isKey"]) for d in mc1["distractors"]}
+    assert counts == {"A": (3, True), "B": (1, False), "C": (0, False)}
+    assert body["items"][-1]["distractors"] == [] # câu đúng/sai không có phân tích phương án
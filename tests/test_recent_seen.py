@@ -0,0 +1,30 @@
+"""
+Bộ lọc câu đã gặp: đọc khi tạo đề luyện tập không tốn truy vấn DB (bản RAM ghi
+xuyên khi nộp bài), ghi có kiểm tra phiên bản không đè mất phần của worker khác.
+"""
+import server
+
+
+def test_reads_are_served_from_write_through_cache(db, monkeypatch):
+    monkeypatch.setattr(server, "_recent_seen_cache", server.OrderedDict())
+    db.users.insert_one({"id": "s1", "role": "student"})
+    server._record_recent_seen("s1", ["q1", "q2"])
+
+    def no_db_read(*args, **kwargs):
+        raise AssertionError("_get_recent_seen không được đọc DB")
+
+    monkeypatch.setattr(type(server.db.users), "find_one", no_db_read)
+    seen = server._get_recent_seen("s1")
+    assert server._recent_seen_contains(seen, "q1") and server._recent_seen_contains(seen, "q2")
+    assert not server._recent_seen_contains(seen, "q3")
+    assert server._get_recent_seen("s-unknown") is None
+
+
+def test_concurrent_writer_is_not_overwritten(db, monkeypatch):
+    monkeypatch.setattr(server, "_recent_seen_cache", server.OrderedDict())
+    db.users.insert_one({"id": "s1", "role": "student"})
+    stale = db.users.find_one({"id": "s1"})
+    server._record_recent_seen("s1", ["q1"])          # worker khác ghi trước
+    server._record_recent_seen("s1", ["q2"], stale)   # bản đọc cũ -> phải đọc lại rồi cộng thêm
+    seen = server._get_recent_seen("s1", db.users.find_one({"id": "s1"}))
+    assert server._recent_seen_contains(seen, "q1") and server._recent_seen_contains(seen, "q2")
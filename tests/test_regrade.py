@@ -0,0 +1,117 @@
+"""
+Chấm lại hàng loạt (_regrade_test, NumPy) phải cho đúng điểm như chấm lúc nộp
+(_submit_result) cho mc / đúng-sai / điền khuyết, kể cả sau khi đổi thang điểm
+hoặc sửa đáp án; bài được chấm tay giữa lúc đọc và lúc ghi không bị đè.
+"""
+import pytest
+
+import server
+
+TEST_ID = "t-regrade"
+QUESTIONS = [
+    {"id": "q-mc", "type": "mc", "options": [
+        {"text": "A", "correct": True}, {"text": "B", "correct": False}, {"text": "C", "correct": False},
+    ]},
+    {"id": "q-tf", "type": "true_false", "options": [
+        {"text": "ý 1", "correct": True}, {"text": "ý 2", "correct": False}, {"text": "ý 3", "correct": True},
+    ]},
+    {"id": "q-fill", "type": "fill_blank", "options": [{"text": "x"}, {"text": "y"}]},
+    {"id": "q-essay", "type": "essay"},
+]
+# Đủ các trường hợp: đúng hết, hoa/thường + khoảng trắng, thiếu ý, không trả lời
+ANSWER_SETS = [
+    {"q-mc": "A", "q-tf": [True, False, True], "q-fill": ["x", "y"]},
+    {"q-mc": "b", "q-tf": [True, True, True], "q-fill": ["X ", "z"]},
+    {"q-mc": None, "q-tf": [False, True, False], "q-fill": []},
+    {"q-mc": "B", "q-tf": [True, False], "q-fill": ["x"]},
+    {"q-mc": " a ", "q-tf": None, "q-fill": ["", "y"]},
+]
+SCORE_FIELDS = ("mcScore", "tfScore", "fillScore", "totalScore")
+
+
+@pytest.fixture
+def graded_test(db):
+    db.questions.insert_many([{**q, "subject": "math", "level": "4"} for q in QUESTIONS])
+    db.tests.insert_one({
+        "id": TEST_ID, "name": "Đề chấm lại", "subject": "math", "level": "4",
+        "questions": [{"id": "q-mc", "points": 2}, {"id": "q-tf", "points": 3},
+                      {"id": "q-fill", "points": 2}, {"id": "q-essay", "points": 3}],
+    })
+    return db
+
+
+def _submit(client, batch, i, answers):
+    payload = [{"questionId": qid, "answer": value} for qid, value in answers.items() if value is not None]
+    res = client.post("/api/results", json={
+        "studentId": f"s{i}", "assignmentId": f"{batch}-a{i}", "testId": TEST_ID, "studentAnswers": payload,
+    })
+    assert res.status_code == 201
+    return res.get_json()["id"]
+
+
+def _submit_all(client, batch):
+    return [_submit(client, batch, i, answers) for i, answers in enumerate(ANSWER_SETS)]
+
+
+def _graded(db, result_id):
+    doc = db.results.find_one({"id": result_id})
+    details = {
+        d["questionId"]: (d.get("pointsGained"), d.get("isCorrect"), d.get("correctItems"))
+        for d in doc["detailedResults"] if d.get("type") in server.AUTO_GRADED_TYPES
+    }
+    return {field: doc.get(field) for field in SCORE_FIELDS}, details
+
+
+def test_regrade_reproduces_submit_grading(graded_test, client):
+    _submit_all(client, "first")
+    report, error = server._regrade_test(TEST_ID, dry_run=True)
+    assert error is None
+    assert report["results"] == len(ANSWER_SETS)
+    assert report["changed"] == 0
+
+
+@pytest.mark.parametrize("overrides", [
+    {"points": {"q-mc": 4, "q-tf": 1.5, "q-fill": 1}},
+    {"answerKeys": {"q-mc": "B", "q-tf": [False, True, True], "q-fill": ["z", "y"]}},
+    {"points": {"q-tf": 6}, "answerKeys": {"q-mc": "C"}},
+])
+def test_regrade_with_overrides_matches_fresh_submission(graded_test, client, overrides):
+    regraded_ids = _submit_all(client, "before")
+    report, error = server._regrade_test(
+        TEST_ID, overrides.get("points"), dry_run=False, key_override=overrides.get("answerKeys")
+    )
+    assert error is None and report["conflicts"] == []
+    fresh_ids = _submit_all(client, "after") # chấm theo đề / ngân hàng đã sửa
+    for regraded_id, fresh_id in zip(regraded_ids, fresh_ids):
+        assert _graded(graded_test, regraded_id) == _graded(graded_test, fresh_id)
+    # Chấm lại lần nữa không còn gì thay đổi
+    assert server._regrade_test(TEST_ID, dry_run=True)[0]["changed"] == 0
+
+
+def test_concurrent_manual_grade_is_not_overwritten(graded_test, client, monkeypatch):
+    result_ids = _submit_all(client, "before")
+    target = result_ids[1]
+    collection_type = type(graded_test.results)
+    original_bulk_write = collection_type.bulk_write
+
+    def grade_then_write(self, ops, *args, **kwargs):
+        # GV chấm câu tự luận sau khi _regrade_test đã đọc bài làm
+        graded_test.results.update_one(
+            {"id": target}, {"$set": {"essayScore": 3.0, "gradedAt": "2026-01-01T00:00:00+07:00"}, "$inc": {"totalScore": 3.0}}
+        )
+        return original_bulk_write(self, ops, *args, **kwargs)
+
+    monkeypatch.setattr(collection_type, "bulk_write", grade_then_write)
+    report, error = server._regrade_test(TEST_ID, {"q-mc": 4}, dry_run=False)
+    monkeypatch.undo()
+
+    assert error is None
+    assert report["conflicts"] == [target]
+    assert target not in {row["resultId"] for row in report["changes"]}
+    doc = graded_test.results.find_one({"id": target})
+    assert doc["essayScore"] == 3.0 and "regradedAt" not in doc
+    # Chạy lại thì bài đó được chấm lại, giữ điểm tự luận
+    report, _ = server._regrade_test(TEST_ID, dry_run=False)
+    assert report["conflicts"] == [] and [row["resultId"] for row in report["changes"]] == [target]
+    doc = graded_test.results.find_one({"id": target})
+    assert doc["totalScore"] == round(doc["mcScore"] + doc["tfScore"] + doc["fillScore"] + 3.0, 2)
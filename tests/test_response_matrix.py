@@ -0,0 +1,115 @@
+"""
+Bộ đệm ma trận bài làm trên đĩa (RESPONSE_MATRIX_CACHE=1):
+- bài làm mới mà tác vụ ghi segment còn chờ -> vẫn trả generation hiện tại, không dựng lại;
+- sau khi hàng đợi ghi segment (nộp mới, nộp lại, chấm lại từng phần) ma trận gộp
+  base + segment phải khớp ma trận dựng lại từ MongoDB.
+"""
+import numpy as np
+import pytest
+
+import server
+
+TEST_ID = "t-matrix"
+OPTIONS = ["A", "B", "C"]
+KEYS = {"q1": "A", "q2": "B", "q3": "C"}
+
+
+@pytest.fixture
+def matrix_test(db):
+    db.questions.insert_many([
+        {"id": qid, "type": "mc", "subject": "math", "level": "4",
+         "options": [{"text": text, "correct": text == key} for text in OPTIONS]}
+        for qid, key in KEYS.items()
+    ] + [{"id": "q-essay", "type": "essay", "subject": "math", "level": "4"}])
+    db.tests.insert_one({"id": TEST_ID, "name": "Đề ma trận", "subject": "math", "level": "4",
+                         "questions": [{"id": qid, "points": 1} for qid in [*KEYS, "q-essay"]]})
+    return db
+
+
+def _submit(client, student, answers):
+    res = client.post("/api/results", json={
+        "studentId": student, "assignmentId": f"a-{student}", "testId": TEST_ID,
+        "studentAnswers": [{"questionId": qid, "answer": value} for qid, value in answers.items()],
+    })
+    assert res.status_code == 201
+    return res.get_json()["id"]
+
+
+def _forget_in_process_cache():
+    with server._response_matrix_lock:
+        server._response_matrix_mmaps.clear()
+
+
+def _by_result(matrix):
+    order = np.argsort(matrix["resultIds"])
+    rows = {name: np.asarray(matrix[name])[order].tolist() for name in server.RESPONSE_MATRIX_ARRAYS}
+    rows.update({name: [matrix[name][i] for i in order] for name in server.RESPONSE_MATRIX_ROW_FIELDS})
+    return rows
+
+
+def _assert_matches_rebuild(matrix):
+    test_doc = server.db.tests.find_one({"id": TEST_ID})
+    assert _by_result(matrix) == _by_result(server._build_full_matrix(test_doc))
+
+
+def _no_rebuild(test_doc):
+    raise AssertionError("không được dựng lại cả ma trận khi chỉ còn segment đang chờ")
+
+
+def test_pending_segment_serves_current_generation(matrix_test, client, monkeypatch):
+    for i, answer in enumerate("ABC"):
+        _submit(client, f"s{i}", {"q1": answer, "q2": "B"})
+    assert len(server._load_response_matrix(TEST_ID)["resultIds"]) == 3
+
+    # Hàng đợi chưa chạy: bài nộp mới chỉ nằm trong derived_tasks
+    drain = server._drain_derived_tasks
+    monkeypatch.setattr(server, "_drain_derived_tasks", lambda: 0)
+    _submit(client, "s3", {"q1": "A", "q2": "A", "q3": "C"})
+    assert server._matrix_segment_pending(TEST_ID)
+
+    build = server._build_full_matrix
+    monkeypatch.setattr(server, "_build_full_matrix", _no_rebuild)
+    assert len(server._load_response_matrix(TEST_ID)["resultIds"]) == 3 # bản trong RAM của worker
+    _forget_in_process_cache()
+    assert len(server._load_response_matrix(TEST_ID)["resultIds"]) == 3 # đọc lại từ đĩa
+
+    # Hàng đợi ghi segment -> đọc thấy bài mới, vẫn không dựng lại
+    drain()
+    assert not server._matrix_segment_pending(TEST_ID)
+    matrix = server._load_response_matrix(TEST_ID)
+    assert matrix["segments"] == 1 and len(matrix["resultIds"]) == 4
+    monkeypatch.setattr(server, "_build_full_matrix", build)
+    _assert_matches_rebuild(matrix)
+
+
+def test_lag_without_pending_task_rebuilds(matrix_test, client):
+    _submit(client, "s0", {"q1": "A"})
+    server._load_response_matrix(TEST_ID)
+    generation = server._read_matrix_generation(TEST_ID)
+    # Bài làm ghi thẳng vào DB (không qua hook) -> không có tác vụ chờ -> phải dựng lại
+    matrix_test.results.insert_one({"id": "r-direct", "testId": TEST_ID, "studentId": "s9", "gradingStatus": "Hoàn tất",
+                                    "detailedResults": [{"questionId": "q1", "studentAnswer": "B", "pointsGained": 0}]})
+    matrix_test.tests.update_one({"id": TEST_ID}, {"$inc": {"resultsVersion": 1, "submittedCount": 1}})
+    assert len(server._load_response_matrix(TEST_ID)["resultIds"]) == 2
+    assert server._read_matrix_generation(TEST_ID) != generation
+
+
+def test_segments_match_rebuild_after_resubmit_and_grading(matrix_test, client, monkeypatch):
+    first = {f"s{i}": _submit(client, f"s{i}", {"q1": OPTIONS[i % 3], "q3": "C"}) for i in range(4)}
+    server._load_response_matrix(TEST_ID)
+    _submit(client, "s1", {"q1": "A", "q2": "B", "q3": "C"})  # nộp lại: thay dòng cũ
+    _submit(client, "s4", {"q2": "B"})                        # nộp mới: thêm dòng
+    graded = client.post(f"/api/results/{first['s2']}/grade", json={"essays": [{"questionId": "q-essay", "teacherScore": 1}]})
+    assert graded.status_code == 200
+    matrix = server._load_response_matrix(TEST_ID)
+    assert matrix["segments"] >= 2 and len(matrix["resultIds"]) == 5
+    _assert_matches_rebuild(matrix)
+
+    # Quá số segment cho phép -> gộp thành generation mới, vẫn khớp
+    monkeypatch.setattr(server, "RESPONSE_MATRIX_MAX_SEGMENTS", 1)
+    before = server._read_matrix_generation(TEST_ID)
+    _submit(client, "s5", {"q1": "C"})
+    assert server._read_matrix_generation(TEST_ID) != before
+    matrix = server._load_response_matrix(TEST_ID)
+    assert matrix["segments"] == 0 and len(matrix["resultIds"]) == 6
+    _assert_matches_rebuild(matrix)
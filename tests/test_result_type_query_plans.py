@@ -0,0 +1,96 @@
+"""
+Bộ lọc resultType (thay cho regex "^[Ôn tập" trên testName) phải dùng được index:
+chạy explain() lại đúng các lệnh server đã gửi tới collection results và kiểm tra
+kế hoạch thắng có IXSCAN, không có COLLSCAN. Cần mongod thật (TEST_MONGODB_URI).
+"""
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from bson import SON
+
+import server
+from conftest import result_commands
+
+pytestmark = pytest.mark.skipif(not os.getenv("TEST_MONGODB_URI"), reason="explain() cần mongod thật (TEST_MONGODB_URI)")
+
+_COMMAND_META_FIELDS = ("lsid", "txnNumber", "$db", "$clusterTime", "$readPreference")
+
+
+@pytest.fixture
+def results(db):
+    server._ensure_indexes()
+    start = datetime(2025, 3, 1, 2, 0)
+    docs = []
+    for i in range(300):
+        result_type = (server.RESULT_TYPE_OFFICIAL, server.RESULT_TYPE_REVIEW, server.RESULT_TYPE_LEARNING_PATH)[i % 3]
+        docs.append({
+            "id": f"r{i}", "testId": f"t{i % 7}", "testName": f"Đề {i % 7}", "studentId": f"s{i % 10}",
+            "className": f"4{'AB'[i % 2]}", "subject": ("math", "viet")[i % 2], "resultType": result_type,
+            "totalScore": i % 11, "gradingStatus": "Hoàn tất", "submittedAtDt": start + timedelta(hours=i),
+            "detailedResults": [{"questionId": f"q{i % 5}", "isCorrect": i % 2 == 0, "pointsGained": 1, "maxPoints": 1}],
+        })
+    db.results.insert_many(docs)
+    return docs
+
+
+def _plan_stages(plan):
+    """Mọi giá trị 'stage' trong kết quả explain (bỏ rejectedPlans); gồm cả $cursor của aggregate."""
+    if isinstance(plan, dict):
+        stages = [plan["stage"]] if isinstance(plan.get("stage"), str) else []
+        for key, value in plan.items():
+            if key != "rejectedPlans":
+                stages += _plan_stages(value)
+        return stages
+    if isinstance(plan, list):
+        return [stage for item in plan for stage in _plan_stages(item)]
+    return []
+
+
+def _explain(command):
+    body = SON((key, value) for key, value in command.items() if key not in _COMMAND_META_FIELDS)
+    return server.db.command(SON([("explain", body), ("verbosity", "queryPlanner")]))
+
+
+def _command_filter(command):
+    """Điều kiện lọc của lệnh find / count / distinct / aggregate ($match đầu pipeline)."""
+    if "pipeline" in command:
+        first = (command["pipeline"] or [{}])[0]
+        return first.get("$match") or {}
+    return command.get("filter") or command.get("query") or {}
+
+
+def _assert_result_type_queries_use_index(run):
+    result_commands.commands.clear()
+    run()
+    commands = [command for command in result_commands.commands if "resultType" in str(_command_filter(command))]
+    assert commands, "Không bắt được lệnh nào lọc theo resultType"
+    for command in commands:
+        stages = _plan_stages(_explain(command))
+        assert "COLLSCAN" not in stages, (command, stages)
+        assert "IXSCAN" in stages, (command, stages)
+
+
+def test_student_progress_analysis(results):
+    _assert_result_type_queries_use_index(
+        lambda: server._get_student_progress_analysis("s1", None, "math", "2025-03-01", "2025-03-10")
+    )
+
+
+def test_class_progress_analysis(results):
+    _assert_result_type_queries_use_index(lambda: server._get_student_progress_analysis(None, "4A", None, None, None))
+
+
+def test_student_review_data(results):
+    _assert_result_type_queries_use_index(lambda: server._get_student_review_data("s1", None, None, None))
+
+
+def test_system_dashboard(client, results):
+    _assert_result_type_queries_use_index(lambda: client.get("/api/reports/system_dashboard?noCache=1"))
+
+
+def test_request_review_test(client, results):
+    # Chỉ quan tâm các truy vấn bài ôn tập cũ (mastery check), không quan tâm đề có sinh được hay không
+    _assert_result_type_queries_use_index(
+        lambda: client.post("/api/student/request-review-test", json={"studentId": "s1", "forceCreate": True})
+    )
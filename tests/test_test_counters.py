@@ -0,0 +1,51 @@
+"""
+_reconcile_test_counters: sửa đề bị lệch, nhưng không đè mất $inc của
+nộp / chấm / giao bài xen vào giữa lúc đếm lại và lúc ghi.
+"""
+import server
+
+
+def _seed(db):
+    db.tests.insert_many([
+        {"id": "t-drift", "assignedCount": 5, "submittedCount": 9, "gradedCount": 0},
+        {"id": "t-busy", "assignedCount": 0, "submittedCount": 0, "gradedCount": 0},
+    ])
+    db.assignments.insert_many([{"id": f"a{i}", "testId": "t-busy", "studentId": f"s{i}"} for i in range(2)])
+    db.results.insert_many([
+        {"id": "r0", "testId": "t-drift", "studentId": "s0", "gradingStatus": "Hoàn tất"},
+        {"id": "r1", "testId": "t-busy", "studentId": "s0", "gradingStatus": "Đang Chấm"},
+    ])
+
+
+def _counters(db, test_id):
+    doc = db.tests.find_one({"id": test_id})
+    return tuple(doc.get(field) for field in server.TEST_COUNTER_FIELDS)
+
+
+def test_reconcile_fixes_drift(db):
+    _seed(db)
+    assert server._reconcile_test_counters() == 2
+    assert _counters(db, "t-drift") == (0, 1, 1)
+    assert _counters(db, "t-busy") == (2, 1, 0)
+    assert server._reconcile_test_counters() == 0
+
+
+def test_concurrent_increment_is_not_lost(db, monkeypatch):
+    _seed(db)
+    collection_type = type(db.tests)
+    original_bulk_write = collection_type.bulk_write
+
+    def submit_then_write(self, ops, *args, **kwargs):
+        # 1 bài nộp mới của t-busy sau khi đã đếm lại (kết quả + $inc bộ đếm)
+        monkeypatch.setattr(collection_type, "bulk_write", original_bulk_write)
+        db.results.insert_one({"id": "r2", "testId": "t-busy", "studentId": "s1", "gradingStatus": "Đang Chấm"})
+        server._inc_test_counters({"t-busy": {"submittedCount": 1}})
+        return original_bulk_write(self, ops, *args, **kwargs)
+
+    monkeypatch.setattr(collection_type, "bulk_write", submit_then_write)
+    assert server._reconcile_test_counters() == 1 # t-busy bị bỏ qua, không $set đè
+    assert _counters(db, "t-drift") == (0, 1, 1)
+    assert _counters(db, "t-busy") == (0, 1, 0)
+    # Lượt sau đếm lại đúng cả bài vừa nộp
+    assert server._reconcile_test_counters() == 1
+    assert _counters(db, "t-busy") == (2, 2, 0)
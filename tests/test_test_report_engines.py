@@ -0,0 +1,88 @@
+"""
+/api/reports/test/<id>: pipeline $facet (aggregate) và ma trận bài làm (matrix)
+phải cho cùng kết quả với cách tính Python cũ (python) trên cùng dữ liệu.
+"""
+import pytest
+
+import server
+
+TEST_ID = "t-report"
+QUESTION_IDS = ["q1", "q2", "q3", "q-deleted"]
+# Có cả điểm nằm đúng cận nhóm (2, 4, 6, 8) và bài chưa có totalScore
+SCORES = [None, 0, 1.5, 2, 2.01, 3.99, 4, 4.5, 6, 6.5, 8, 8.25, 9.75, 10]
+
+
+def _details(i):
+    details = [
+        {"questionId": "q1", "isCorrect": i % 2 == 0},
+        # isCorrect None (đúng 1 phần / chưa chấm) tính là sai
+        {"questionId": "q2", "isCorrect": None if i % 3 == 0 else i % 3 == 1},
+        {"questionId": "q-deleted", "isCorrect": i % 5 == 0},
+        {"questionId": "q-not-in-test", "isCorrect": True},
+    ]
+    if i % 4:
+        details.append({"questionId": "q3", "isCorrect": i % 4 == 1})
+    return details
+
+
+@pytest.fixture
+def results(db):
+    db.questions.insert_many([
+        {"id": "q1", "q": "Câu 1", "type": "mc", "points": 1},
+        {"id": "q2", "q": "Câu 2", "type": "true_false", "points": 1},
+        {"id": "q3", "type": "essay", "points": 1}, # không có nội dung -> "..."
+    ])
+    db.tests.insert_one({
+        "id": TEST_ID, "name": "Đề đối chiếu", "subject": "math", "level": "4",
+        "questions": [{"id": qid, "points": 1} for qid in QUESTION_IDS],
+    })
+    docs = []
+    for i, score in enumerate(SCORES):
+        doc = {
+            "id": f"r{i}", "testId": TEST_ID, "studentId": f"s{i % 5}", "className": "4A" if i % 2 else "4B",
+            "gradingStatus": "Hoàn tất", "detailedResults": _details(i),
+        }
+        if score is not None:
+            doc["totalScore"] = score
+        docs.append(doc)
+    db.results.insert_many(docs)
+    return docs
+
+
+def _normalized(report):
+    if report is None:
+        return None
+    summary, distribution, items = report
+    return (
+        {key: round(float(summary[key]), 6) for key in ("count", "sum", "max", "min")},
+        dict(distribution),
+        sorted(items, key=lambda item: item["questionId"]),
+    )
+
+
+@pytest.mark.parametrize("engine", ["aggregate", "matrix"])
+@pytest.mark.parametrize("scope", [{}, {"className": "4A"}, {"className": "4B"}, {"studentId": "s3"}, {"studentId": "nobody"}])
+def test_engine_matches_python(results, engine, scope):
+    query = {"testId": TEST_ID, **scope}
+    expected = _normalized(server._test_report_python(query, QUESTION_IDS))
+    assert _normalized(server._TEST_REPORT_ENGINES[engine](query, QUESTION_IDS)) == expected
+
+
+def test_python_oracle_buckets_upper_bounds(results):
+    """Nhóm điểm là (a, b]: 2 thuộc "0-2", 2.01 thuộc "3-4"; bài chưa có điểm tính là 0."""
+    _, distribution, items = server._test_report_python({"testId": TEST_ID}, QUESTION_IDS)
+    assert distribution == {"0-2": 4, "3-4": 3, "5-6": 2, "7-8": 2, "9-10": 3}
+    by_id = {item["questionId"]: item for item in items}
+    assert by_id["q-deleted"]["questionText"] == "Câu hỏi đã bị xóa"
+    assert by_id["q3"]["questionText"] == "..."
+    assert "q-not-in-test" not in by_id
+
+
+@pytest.mark.parametrize("engine", ["aggregate", "matrix"])
+def test_endpoint_engines_agree(client, results, engine):
+    def report(name):
+        return client.get(f"/api/reports/test/{TEST_ID}?engine={name}&noCache=1").get_json()
+
+    expected = report("python")
+    assert expected["success"] and expected["summary"]
+    assert report(engine) == expected